@@ -0,0 +1,361 @@
+
+# Нагрузочный стенд для обработчиков main.py без обращения к Telegram и Gemini.
+#
+# Запуск:
+#   python benchmark.py --users 50 --iterations 5
+#   python benchmark.py --users 200 --save-baseline bench_baseline.json
+#   python benchmark.py --users 200 --compare bench_baseline.json --tolerance 0.25
+#
+# Бот работает с временной БД (копия idioms.json загружается в неё при старте), Telegram
+# заменён заглушкой StubBot, Gemini - FakeGeminiClient с настраиваемой задержкой и потоковой выдачей.
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import tracemalloc
+import types
+from datetime import datetime, timezone
+from time import monotonic, perf_counter
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 1. Заглушки внешних сервисов
+class FakeResponse:
+    def __init__(self, text: str): self.text = text
+
+class FakeGeminiModels:
+    """Имитация client.aio.models: задержка ответа, разброс и потоковая выдача по частям."""
+
+    def __init__(self, latency: float, jitter: float, stream_chunks: int, chunk_delay: float, answer_len: int):
+        self.latency = latency; self.jitter = jitter
+        self.stream_chunks = stream_chunks; self.chunk_delay = chunk_delay; self.answer_len = answer_len
+        self.calls = 0
+
+    async def _wait(self): await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+    def _answer(self, contents, config=None) -> str:
+        prompt = json.dumps(contents, ensure_ascii=False, default=str)
+        if config and config.get("response_mime_type") == "application/json": # Пакетная проверка практики
+            return json.dumps([{"id": int(number), "correct": random.random() < 0.5, "feedback": "Смысл передан."} for number in re.findall(r'\\"id\\": (\d+)', prompt)])
+        return ("Ответ ассистента по китайскому языку. " * (self.answer_len // 38 + 1))[:self.answer_len]
+
+    async def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        await self._wait()
+        return FakeResponse(self._answer(contents, config))
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.calls += 1
+        text = self._answer(contents, config); size = max(1, len(text) // self.stream_chunks + 1)
+        async def chunks():
+            await self._wait()
+            for start in range(0, len(text), size):
+                yield FakeResponse(text[start:start + size])
+                await asyncio.sleep(self.chunk_delay)
+        return chunks()
+
+class FakeGeminiClient:
+    def __init__(self, **kwargs):
+        self.aio = types.SimpleNamespace(models=FakeGeminiModels(**kwargs))
+        self.models = self.aio.models
+
+def make_stub_bot_class():
+    from telegram import Chat, Message, User
+    from telegram.ext import ExtBot
+
+    class StubBot(ExtBot):
+        """ExtBot, который ничего не отправляет: запоминает вызовы и последние клавиатуры по чатам."""
+
+        def __init__(self, send_latency: float):
+            super().__init__(token="123456:BENCHMARK")
+            with self._unfrozen(): # Bot замораживает атрибуты после __init__
+                self.send_latency = send_latency
+                self.calls = {}
+                self.last_markup = {}
+                self._next_message_id = 1000
+
+        def _record(self, method: str, chat_id=None, reply_markup=None):
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if chat_id is not None and reply_markup is not None: self.last_markup[chat_id] = reply_markup
+
+        def _message(self, chat_id: int, text: str, message_id: int = None):
+            self._next_message_id += 1
+            message = Message(message_id=message_id or self._next_message_id, date=datetime.now(timezone.utc),
+                              chat=Chat(id=chat_id, type="private"), text=text, from_user=self.bot)
+            message.set_bot(self)
+            return message
+
+        async def get_me(self, *args, **kwargs):
+            self._bot_user = User(id=123456, is_bot=True, first_name="Benchmark", username="benchmark_bot")
+            return self._bot_user
+
+        async def send_message(self, chat_id, text, *args, reply_markup=None, **kwargs):
+            self._record("send_message", chat_id, reply_markup)
+            await asyncio.sleep(self.send_latency)
+            return self._message(chat_id, text)
+
+        async def edit_message_text(self, text, chat_id=None, message_id=None, *args, reply_markup=None, **kwargs):
+            self._record("edit_message_text", chat_id, reply_markup)
+            await asyncio.sleep(self.send_latency)
+            return self._message(chat_id, text, message_id)
+
+        async def answer_callback_query(self, *args, **kwargs):
+            self._record("answer_callback_query"); return True
+
+        async def send_chat_action(self, *args, **kwargs):
+            self._record("send_chat_action"); return True
+
+    return StubBot
+
+# 2. Подготовка окружения: временная БД и импорт main
+def import_bot(workdir: str):
+    """Импортирует main.py так, чтобы БД создавалась во временном каталоге."""
+    if REPO_DIR not in sys.path: sys.path.insert(0, REPO_DIR)
+    try: import tokens # noqa: F401 - реальные ключи не нужны, но и не мешают
+    except ImportError:
+        stub = types.ModuleType("tokens"); stub.GEMINI_API_KEY = "benchmark"; stub.TELEGRAM_TOKEN = "123456:BENCHMARK"
+        sys.modules["tokens"] = stub
+    shutil.copy(os.path.join(REPO_DIR, "idioms.json"), os.path.join(workdir, "idioms.json"))
+    previous_dir = os.getcwd(); os.chdir(workdir)
+    try:
+        import main
+        main.open_database() # Импорт модуля БД не открывает: это делает bootstrap при запуске бота
+    finally: os.chdir(previous_dir)
+    main.IDIOMS_JSON_FILE = os.path.join(workdir, "idioms.json")
+    return main
+
+class CommitCounter:
+    """Считает COMMIT и прочие выражения, выполненные соединением-писателем."""
+    def __init__(self): self.commits = 0; self.statements = 0
+    def __call__(self, statement: str):
+        self.statements += 1
+        if statement.startswith("COMMIT"): self.commits += 1
+
+# 3. Синтетические апдейты Telegram
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot; self._update_id = 0; self._message_id = 0
+
+    def _user(self, chat_id: int) -> dict:
+        return {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}", "username": f"user{chat_id}"}
+
+    def _message(self, chat_id: int, text: str, from_bot: bool = False) -> dict:
+        self._message_id += 1
+        sender = {"id": 123456, "is_bot": True, "first_name": "Benchmark"} if from_bot else self._user(chat_id)
+        return {"message_id": self._message_id, "date": int(datetime.now(timezone.utc).timestamp()),
+                "chat": {"id": chat_id, "type": "private"}, "from": sender, "text": text}
+
+    def _build(self, payload: dict):
+        from telegram import Update
+        self._update_id += 1
+        return Update.de_json({"update_id": self._update_id, **payload}, self.bot)
+
+    def text(self, chat_id: int, text: str):
+        message = self._message(chat_id, text)
+        if text.startswith("/"): message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._build({"message": message})
+
+    def callback(self, chat_id: int, data: str):
+        return self._build({"callback_query": {"id": str(self._update_id), "from": self._user(chat_id), "chat_instance": str(chat_id),
+                                               "data": data, "message": self._message(chat_id, "…", from_bot=True)}})
+
+# 4. Сценарии виртуальных пользователей
+class Recorder:
+    def __init__(self): self.samples = {}
+    def add(self, name: str, seconds: float): self.samples.setdefault(name, []).append(seconds)
+
+def percentile(values: list, q: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values); index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+class VirtualUser:
+    def __init__(self, chat_id: int, app, factory: UpdateFactory, recorder: Recorder, think_time: float):
+        self.chat_id = chat_id; self.app = app; self.factory = factory; self.recorder = recorder; self.think_time = think_time
+
+    async def _send(self, name: str, update):
+        started = perf_counter()
+        await self.app.process_update(update)
+        self.recorder.add(name, perf_counter() - started)
+        if self.think_time: await asyncio.sleep(random.uniform(0, self.think_time))
+
+    async def text(self, name: str, text: str): await self._send(name, self.factory.text(self.chat_id, text))
+    async def press(self, name: str, data: str): await self._send(name, self.factory.callback(self.chat_id, data))
+
+    async def press_button(self, name: str, predicate) -> bool:
+        """Нажимает кнопку из последней показанной пользователю клавиатуры (не зависит от формата callback_data)."""
+        markup = self.app.bot.last_markup.get(self.chat_id)
+        for row in (markup.inline_keyboard if markup else ()):
+            for button in row:
+                if button.callback_data and predicate(button.text):
+                    await self.press(name, button.callback_data); return True
+        return False
+
+    async def menu_script(self, main):
+        await self.text("command:/start", "/start")
+        await self.press("button:idiom", "idiom")
+        await self.press_button("button:add_to_dictionary", lambda text: "словарь" in text)
+        await self.press("button:theme", "theme")
+        if main.THEMES: await self.press("button:theme_selected", f"t:{main.theme_key(random.choice(main.THEMES))}")
+        await self.press("button:dictionary", "dictionary")
+        await self.press("button:view_dictionary", "view_dictionary")
+        await self.press("button:repeat_idioms", "repeat_idioms")
+        await self.press("button:settings", "settings")
+        await self.press("button:back", "back")
+
+    async def practice_script(self, main):
+        await self.press("button:practice", "practice")
+        await self.press("button:practice_selected", random.choice(["practice_translate", "practice_example"]))
+        record = main.IDIOM_INDEX.random()
+        answer = random.choice([record.translation if record else "перевод", "не знаю", "some english words"])
+        await self.text("message:practice_answer", answer)
+
+    async def free_mode_script(self, main):
+        await self.press("button:free_mode", "free_mode")
+        for question in ("Что значит 一石二鸟?", "Приведи пример с этой идиомой", "А синонимы есть?"):
+            await self.text("message:free_mode", question)
+        await self.press("button:exit_free_mode", "exit_free_mode")
+
+    async def run(self, main, iterations: int):
+        scripts = [self.menu_script, self.menu_script, self.practice_script, self.practice_script, self.free_mode_script]
+        for _ in range(iterations):
+            await random.choice(scripts)(main)
+        await self.text("command:/log", "/log")
+
+# 5. Измерение задержки цикла событий
+async def sample_loop_lag(interval: float, lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        started = monotonic()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, monotonic() - started - interval))
+
+# 6. Прогон
+async def run_benchmark(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="idiomsbot-bench-")
+    try:
+        main = import_bot(workdir)
+        if not main.db: raise RuntimeError("Не удалось инициализировать БД бота")
+        main.client = FakeGeminiClient(latency=args.llm_latency, jitter=args.llm_latency / 4, stream_chunks=args.stream_chunks,
+                                       chunk_delay=args.chunk_delay, answer_len=args.answer_len)
+        main.STREAM_EDIT_INTERVAL = min(main.STREAM_EDIT_INTERVAL, args.chunk_delay * 2)
+        main.load_idioms_from_json(main.db.writer.cursor(), main.db.writer)
+        main.daily_schedule.load(main.db.writer.cursor())
+        if args.broadcast_rate: main.broadcast_engine.bucket = main.TokenBucket(args.broadcast_rate)
+
+        from telegram.ext import Application, CallbackContext
+        bot = make_stub_bot_class()(send_latency=args.send_latency)
+        app = Application.builder().bot(bot).updater(None).build()
+        main.register_handlers(app)
+        await app.initialize()
+
+        commit_counter = CommitCounter()
+        main.db.writer.set_trace_callback(commit_counter)
+        recorder = Recorder(); lags = []; stop = asyncio.Event()
+        gc.collect(); tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        lag_task = asyncio.create_task(sample_loop_lag(0.01, lags, stop))
+
+        factory = UpdateFactory(bot)
+        users = [VirtualUser(100000 + i, app, factory, recorder, args.think_time) for i in range(args.users)]
+        started = monotonic()
+        await asyncio.gather(*(user.run(main, args.iterations) for user in users))
+        scripts_duration = monotonic() - started
+
+        # Ежедневная рассылка всем виртуальным пользователям в одну минуту
+        slot = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        for user in users: main.daily_schedule.set_user(user.chat_id, slot.strftime("%H:%M"))
+        broadcast_started = perf_counter()
+        await main.send_daily_idiom(CallbackContext(app), slot)
+        recorder.add("job:send_daily_idiom", perf_counter() - broadcast_started)
+
+        await main.action_log.stop()
+        total_duration = monotonic() - started
+        stop.set(); await lag_task
+        gc.collect()
+        memory_after, memory_peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+        main.db.writer.set_trace_callback(None)
+        await app.shutdown()
+
+        handlers = {name: {"count": len(values), "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                           "p95_ms": round(percentile(values, 0.95) * 1000, 2), "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                           "max_ms": round(max(values) * 1000, 2)} for name, values in sorted(recorder.samples.items())}
+        updates = sum(len(values) for name, values in recorder.samples.items() if not name.startswith("job:"))
+        return {
+            "config": vars(args),
+            "handlers": handlers,
+            "updates_per_sec": round(updates / scripts_duration, 1) if scripts_duration else 0.0,
+            "loop_lag_ms": {"p50": round(percentile(lags, 0.50) * 1000, 2), "p99": round(percentile(lags, 0.99) * 1000, 2), "max": round(max(lags, default=0) * 1000, 2)},
+            "db": {"commits": commit_counter.commits, "statements": commit_counter.statements, "commits_per_sec": round(commit_counter.commits / total_duration, 1)},
+            "memory_mb": {"growth": round((memory_after - memory_before) / 2**20, 2), "peak": round(memory_peak / 2**20, 2)},
+            "broadcast": main.broadcast_engine.last_run and {k: v for k, v in main.broadcast_engine.last_run.items() if k != "failed_chat_ids"},
+            "gemini_calls": main.client.aio.models.calls,
+            "duration_sec": round(total_duration, 2),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_report(report: dict):
+    print(f"\n{'Обработчик':<32}{'N':>7}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, row in report["handlers"].items():
+        print(f"{name:<32}{row['count']:>7}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    print(f"\nАпдейтов в секунду: {report['updates_per_sec']}")
+    print(f"Задержка цикла событий, мс: {report['loop_lag_ms']}")
+    print(f"БД: {report['db']}")
+    print(f"Память, МБ: {report['memory_mb']}")
+    print(f"Рассылка: {report['broadcast']}")
+    print(f"Вызовов Gemini: {report['gemini_calls']}, длительность прогона: {report['duration_sec']} с")
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> list:
+    """Список регрессий p95 относительно сохранённого прогона."""
+    regressions = []
+    for name, row in report["handlers"].items():
+        base = baseline.get("handlers", {}).get(name)
+        if base and base["p95_ms"] > 0 and row["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']} -> {row['p95_ms']} мс")
+    base_lag = baseline.get("loop_lag_ms", {}).get("p99", 0)
+    if base_lag and report["loop_lag_ms"]["p99"] > base_lag * (1 + tolerance) + 1:
+        regressions.append(f"задержка цикла событий p99 {base_lag} -> {report['loop_lag_ms']['p99']} мс")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд IdiomsBot с заглушками Telegram и Gemini")
+    parser.add_argument("--users", type=int, default=50, help="Число одновременных виртуальных пользователей")
+    parser.add_argument("--iterations", type=int, default=5, help="Сценариев на пользователя")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Максимальная пауза между действиями, сек.")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Средняя задержка ответа Gemini, сек.")
+    parser.add_argument("--stream-chunks", type=int, default=5, help="Частей в потоковом ответе")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="Пауза между частями потока, сек.")
+    parser.add_argument("--answer-len", type=int, default=1200, help="Длина ответа свободного режима, символов")
+    parser.add_argument("--send-latency", type=float, default=0.005, help="Задержка заглушки Telegram API, сек.")
+    parser.add_argument("--broadcast-rate", type=float, default=0, help="Лимит рассылки, сообщ./с (0 - как в main.py)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="Сохранить отчёт в JSON-файл")
+    parser.add_argument("--save-baseline", help="Сохранить отчёт как эталон")
+    parser.add_argument("--compare", help="Сравнить с эталоном и завершиться с кодом 1 при регрессии")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Допустимый рост p95 относительно эталона")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f: baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print("\nРегрессии относительно эталона:\n  " + "\n  ".join(regressions)); return 1
+        print("\nРегрессий относительно эталона нет.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""Локальная проверка ответов практики (grade_locally): засчитываются только ответы, совпадающие с переводом пословно с точностью до опечаток."""
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="module")
+def main():
+    # grade_locally - чистая функция: импорт модуля не открывает БД и не читает idioms.json, нужен только tokens
+    try: import tokens # noqa: F401
+    except ImportError:
+        stub = types.ModuleType("tokens"); stub.GEMINI_API_KEY = "test"; stub.TELEGRAM_TOKEN = "123456:TEST"
+        sys.modules["tokens"] = stub
+    import main
+    return main
+
+
+IDIOM = {"idiom": "开拓进取", "translation": "Осваивать новое и двигаться вперед", "meaning": "Стремление к новому и развитию"}
+
+
+def test_close_translation_is_correct_locally(main):
+    is_correct, confidence, _ = main.grade_locally("translate", IDIOM, "осваивать новое и двигаться вперёд!")
+    assert is_correct is True and confidence >= main.PRACTICE_LOCAL_CONFIDENCE
+
+
+def test_negated_answer_is_deferred_to_gemini(main):
+    assert main.grade_locally("translate", IDIOM, "не осваивать новое и не двигаться вперед")[0] is None
+    assert main.grade_locally("translate", IDIOM, "Не значит осваивать новое и двигаться вперед")[0] is None
+
+
+def test_dropped_negation_is_deferred_to_gemini(main):
+    idiom = {"idiom": "祸不单行", "translation": "Беда не приходит одна", "meaning": ""}
+    assert main.grade_locally("translate", idiom, "беда приходит одна")[0] is None
+    assert main.grade_locally("translate", idiom, "беда не приходит одна")[0] is True
+
+
+@pytest.mark.parametrize("idiom, answer", [
+    (IDIOM, "осваивать старое и двигаться вперед"),
+    (IDIOM, "осваивать новое и двигаться назад"),
+    ({"idiom": "一举两得", "translation": "Одним выстрелом двух зайцев", "meaning": "Решить две задачи одним действием."}, "Убить трёх зайцев одним камнем"),
+    ({"idiom": "画蛇添足", "translation": "Рисовать змею и добавить ей ноги", "meaning": "Испортить дело лишним усердием."}, "рисовать змею и добавить ей руки"),
+])
+def test_similar_but_wrong_answer_is_not_correct_locally(main, idiom, answer):
+    assert main.grade_locally("translate", idiom, answer)[0] is None
+
+
+def test_typo_in_a_word_is_tolerated(main):
+    is_correct, confidence, _ = main.grade_locally("translate", IDIOM, "осваивать новое и двигатся впиред")
+    assert is_correct is True and confidence >= main.PRACTICE_LOCAL_CONFIDENCE